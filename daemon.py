@@ -0,0 +1,378 @@
+"""
+The local worker -- A long-lived process that sets up the local API stubs
+once, keeps them (and any imported models) warm, and runs shell, loaddata and
+dumpjson commands sent to it over a Unix socket. Tasks targeting the local
+environment hand their work off to the worker automatically when it's running.
+"""
+
+import errno
+import functools
+import hashlib
+import logging
+import os
+import select
+import socket
+import stat
+import sys
+import tempfile
+import time
+import traceback
+
+from django.utils import simplejson as json
+from google.appengine.api import apiproxy_stub_map
+from fabric.api import env, abort
+
+import utils
+
+
+# The worker's socket and log live in a directory private to the current user.
+# It is under the temp dir because Unix socket paths are limited to around 100
+# characters.
+RUNTIME_DIR = os.path.join(tempfile.gettempdir(), 'gaefab-%d' % os.getuid())
+
+# Each project gets its own worker, so the socket is named after a hash of the
+# project root.
+_name = hashlib.md5(utils.PROJECT_ROOT).hexdigest()[:12]
+SOCKET_PATH = os.path.join(RUNTIME_DIR, _name + '.sock')
+LOG_PATH = os.path.join(RUNTIME_DIR, _name + '.log')
+
+# How many seconds the worker will sit idle before shutting itself down
+IDLE_TIMEOUT = 600
+
+# How many seconds to wait for a newly started worker to begin listening
+STARTUP_TIMEOUT = 60
+
+# How many seconds the worker will wait on a client to send its command
+CONNECTION_TIMEOUT = 10
+
+
+def run_shell(cmd):
+    exec cmd in utils.shell_namespace()
+
+def run_loaddata(path):
+    import fixtures
+    logging.getLogger().setLevel(logging.INFO)
+    fixtures.load_fixtures(path)
+
+def run_dumpjson(kinds):
+    import fixtures
+    for kind in kinds.split(','):
+        print fixtures.serialize_entities(kind)
+
+# The commands the worker knows how to run, which mirror the tasks of the same
+# names minus their environment setup.
+COMMANDS = {
+    'shell': run_shell,
+    'loaddata': run_loaddata,
+    'dumpjson': run_dumpjson,
+    }
+
+
+class Output(object):
+    """A file-like object that collects everything written to it as unicode,
+    so that a mix of unicode and byte strings can always be sent back to the
+    client. Bytes that aren't valid UTF-8 are replaced.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, s):
+        if isinstance(s, str):
+            s = s.decode('utf-8', 'replace')
+        self.chunks.append(s)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return u''.join(self.chunks)
+
+
+class Worker(object):
+    """Serves commands sent to SOCKET_PATH until it has been idle for
+    idle_timeout seconds or is asked to stop.
+    """
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.started = time.time()
+        self.last_active = self.started
+        self.served = 0
+        self.stopping = False
+
+    def serve(self, ready_fd=None):
+        """Sets up the local stubs and serves commands. If given, ready_fd is
+        written to and closed once the worker is listening.
+        """
+        utils.prep_local_shell()
+
+        # Only the current user may connect, since the worker will run any
+        # Python code it is sent.
+        old_umask = os.umask(0077)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(SOCKET_PATH)
+        finally:
+            os.umask(old_umask)
+        st = os.lstat(SOCKET_PATH)
+        bound = (st.st_dev, st.st_ino)
+        sock.listen(5)
+        if ready_fd is not None:
+            os.write(ready_fd, 'ready')
+            os.close(ready_fd)
+
+        try:
+            while not self.stopping:
+                remaining = self.idle_timeout - (time.time() - self.last_active)
+                if remaining <= 0:
+                    break
+                ready, _, _ = select.select([sock], [], [], remaining)
+                if ready:
+                    conn, _ = sock.accept()
+                    conn.settimeout(CONNECTION_TIMEOUT)
+                    # A bad request or a client that goes away early must
+                    # not take the worker down with it.
+                    try:
+                        self.handle(conn)
+                    except Exception:
+                        traceback.print_exc()
+                    finally:
+                        conn.close()
+        finally:
+            # Remove the socket before closing it, and only if it is still
+            # ours, so a worker started while this one shuts down keeps its
+            # socket.
+            try:
+                st = os.lstat(SOCKET_PATH)
+            except OSError:
+                pass
+            else:
+                if (st.st_dev, st.st_ino) == bound:
+                    os.remove(SOCKET_PATH)
+            sock.close()
+
+    def handle(self, conn):
+        request = json.loads(conn.makefile('rb').readline())
+        command = request['command']
+        if command == 'status':
+            response = self.status()
+        elif command == 'stop':
+            self.stopping = True
+            response = self.status()
+        else:
+            response = self.execute(
+                command, request.get('args', []), request.get('kwargs', {}))
+            self.served += 1
+            self.last_active = time.time()
+        # The command has already run, so the client must get a reply it
+        # can decode even if the response can't be encoded.
+        try:
+            reply = json.dumps(response)
+        except Exception:
+            reply = json.dumps({ 'output': u'', 'error': format_exc() })
+        conn.sendall(reply)
+
+    def execute(self, command, args, kwargs):
+        """Runs the given command, capturing anything it prints or logs so it
+        can be sent back to the client.
+        """
+        output = Output()
+        handler = logging.StreamHandler(output)
+        logging.getLogger().addHandler(handler)
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = output
+        try:
+            if command not in COMMANDS:
+                raise ValueError('Unknown worker command: %r' % command)
+            reload_datastore()
+            # Keyword argument names must be strings, not unicode
+            kwargs = dict((str(k), v) for k, v in kwargs.iteritems())
+            COMMANDS[command](*args, **kwargs)
+        except (Exception, SystemExit):
+            error = format_exc()
+        else:
+            error = None
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            logging.getLogger().removeHandler(handler)
+        return { 'output': output.getvalue(), 'error': error }
+
+    def status(self):
+        now = time.time()
+        return {
+            'pid': os.getpid(),
+            'application': env.gae.application,
+            'socket': SOCKET_PATH,
+            'uptime': now - self.started,
+            'idle': now - self.last_active,
+            'idle_timeout': self.idle_timeout,
+            'served': self.served,
+            }
+
+
+def format_exc():
+    """Returns the current exception's traceback as unicode."""
+    return traceback.format_exc().decode('utf-8', 'replace')
+
+def reload_datastore():
+    """Reloads the datastore stub's in-memory copy of the datastore from disk,
+    so that the worker sees (and doesn't overwrite) anything written by other
+    processes since it started. Stubs that don't keep such a copy are left
+    alone.
+    """
+    stub = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+    if hasattr(stub, 'Read'):
+        stub.Clear()
+        stub.Read()
+
+def is_private_dir(path):
+    """Returns True if the given path is a directory that belongs to and is
+    only accessible by the current user.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return (stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid()
+            and not st.st_mode & 077)
+
+def is_trusted_socket():
+    """Returns True if SOCKET_PATH is a socket belonging to the current user
+    in a private RUNTIME_DIR, and so can't have been put there by anyone
+    else.
+    """
+    if not is_private_dir(RUNTIME_DIR):
+        return False
+    try:
+        st = os.lstat(SOCKET_PATH)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
+
+def ensure_runtime_dir():
+    """Creates RUNTIME_DIR if necessary, aborting if it exists but isn't
+    private to the current user.
+    """
+    try:
+        os.mkdir(RUNTIME_DIR, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    if not is_private_dir(RUNTIME_DIR):
+        abort('%s must be a directory owned by and only accessible to the '
+              'current user.' % RUNTIME_DIR)
+
+def request(command, *args, **kwargs):
+    """Sends a command to the worker and returns its decoded response, or None
+    if no trusted worker is running. Once the worker may have run the command,
+    any failure to get its response aborts, since running the command again
+    elsewhere could repeat it.
+    """
+    if not is_trusted_socket():
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        message = { 'command': command, 'args': args, 'kwargs': kwargs }
+        try:
+            sock.connect(SOCKET_PATH)
+            sock.sendall(json.dumps(message) + '\n')
+        except socket.error:
+            return None
+        chunks = []
+        try:
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except socket.error, e:
+            # A worker that hit its idle timeout while we were waiting to be
+            # accepted resets the connection without ever reading our
+            # request, so the command was never run.
+            if e.errno == errno.ECONNRESET and not chunks:
+                return None
+            abort('Lost the connection to the local worker: %s' % e)
+    finally:
+        sock.close()
+    if not chunks:
+        abort('The local worker did not reply; see %s' % LOG_PATH)
+    try:
+        return json.loads(''.join(chunks))
+    except ValueError:
+        abort('The local worker sent an invalid reply; see %s' % LOG_PATH)
+
+def run(command, *args, **kwargs):
+    """Runs the given command on the worker, printing its output. Returns
+    False without doing anything if there is no worker to run it, or if RPC
+    tracing is on (the worker's API calls can't be traced from here).
+    """
+    if getattr(env, 'gae_trace', None) is not None:
+        return False
+    response = request(command, *args, **kwargs)
+    if response is None:
+        return False
+    sys.stdout.write(response['output'].encode('utf-8'))
+    if response['error']:
+        abort('Local worker command failed:\n%s' % response['error'])
+    return True
+
+def delegate_local(func):
+    """Decorator that hands the given task off to the worker command of the
+    same name when no deployment target was given and a worker is running.
+    Otherwise, the task is run as usual.
+    """
+    @functools.wraps(func)
+    def decorated_func(*args, **kwargs):
+        if not hasattr(env, 'gae') and run(func.__name__, *args, **kwargs):
+            return
+        return func(*args, **kwargs)
+    return decorated_func
+
+def start(idle_timeout=IDLE_TIMEOUT):
+    """Starts a worker in the background, detached from the current process,
+    and waits for it to begin listening. Returns the worker's status.
+    """
+    ensure_runtime_dir()
+    if request('status') is not None:
+        abort('A local worker is already running at %s' % SOCKET_PATH)
+    # Clean up after a worker that didn't exit cleanly. This is safe because
+    # nobody else can write to RUNTIME_DIR.
+    if os.path.lexists(SOCKET_PATH):
+        os.remove(SOCKET_PATH)
+
+    # The worker signals that it is listening by writing to this pipe. If it
+    # dies during setup instead, the pipe is closed without being written to.
+    ready_r, ready_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(ready_r)
+        # Double fork so the worker is reparented to init and won't be left
+        # as a zombie when it exits.
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        # The worker's API calls can't be reported, so don't trace them
+        env.gae_trace = None
+        log = open(LOG_PATH, 'a', 0)
+        devnull = open(os.devnull, 'r')
+        os.dup2(devnull.fileno(), sys.stdin.fileno())
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+        try:
+            Worker(idle_timeout=idle_timeout).serve(ready_fd=ready_w)
+        except:
+            traceback.print_exc()
+        os._exit(0)
+
+    os.close(ready_w)
+    os.waitpid(pid, 0)
+    try:
+        ready, _, _ = select.select([ready_r], [], [], STARTUP_TIMEOUT)
+        started = ready and os.read(ready_r, 5)
+    finally:
+        os.close(ready_r)
+    status = request('status') if started else None
+    if status is None:
+        abort('The local worker did not start; see %s' % LOG_PATH)
+    return status
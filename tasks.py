@@ -11,7 +11,10 @@ import sys
 
 from fabric.api import env, local, lcd, abort
 
+# utils must be imported first, since it puts the SDK's libraries on sys.path
 import utils
+import daemon
+import tracing
 
 
 @utils.target_required
@@ -150,19 +153,11 @@ Usage:
     fab production shell:cmd="memcache.flush_all()"
 """
 
-    # Import the modules we want to make available by default
-    from google.appengine.api import urlfetch
-    from google.appengine.api import memcache
-    from google.appengine.ext import deferred
-    from google.appengine.ext import db
-
     # Fix the path
     path = path or utils.REMOTE_API_PATH
 
     # Build a dict usable as locals() from the modules we want to use
-    modname = lambda m: m.__name__.rpartition('.')[-1]
-    mods = [db, deferred, memcache, sys, urlfetch]
-    mods = dict((modname(m), m) for m in mods)
+    mods = utils.shell_namespace()
 
     # The banner for any kind of shell
     banner = 'Python %s\n\nImported modules: %s\n' % (
@@ -176,8 +171,11 @@ Usage:
         # Actually prepare the remote shell
         utils.prep_remote_shell(path=path)
 
-    # Otherwise, we're starting a local shell
+    # Otherwise, we're starting a local shell, unless there's a command to run
+    # and a local worker is running to run it for us
     else:
+        if cmd and daemon.run('shell', cmd):
+            return
         utils.prep_local_shell()
 
     # Define the kinds of shells we're going to try to run
@@ -212,6 +210,7 @@ Usage:
                 plain_shell()
 
 
+@daemon.delegate_local
 @utils.ensure_gae_env
 def loaddata(path):
     """Load the specified JSON fixtures.  If preceded by a deployment target,
@@ -234,6 +233,7 @@ Usage:
     logging.getLogger().setLevel(logging.INFO)
     fixtures.load_fixtures(path)
 
+@daemon.delegate_local
 def dumpjson(kinds):
     """Dumps data from the local or remote datastore in JSON format.
 
@@ -289,5 +289,90 @@ Usage:
     return shell(cmd=cmds[cmd])
 
 
+def trace(enabled=True, dump=None):
+    """Turns on RPC tracing for the tasks that follow it. Every App Engine API
+call they make is recorded, and a summary of the calls, grouped by service and
+method with latency histograms, is printed when fab exits.
+
+Optional arguments:
+
+    :enabled -- Whether tracing is turned on. Defaults to on; pass 0 to turn
+    it off.
+
+    :dump -- A path to which the raw trace records will be written, one JSON
+    object per line.
+
+Usage:
+
+    # Trace a fixture load onto staging
+    fab staging trace:1 loaddata:groups/fixtures/test_groups.json
+
+    # Trace a local shell command and keep the raw trace
+    fab trace:dump=trace.json shell:cmd="db.Query().count()"
+"""
+    trace = getattr(env, 'gae_trace', None)
+    if str(enabled).lower() in ('0', 'false', 'no', 'off'):
+        if trace is not None:
+            trace.disable()
+        env.gae_trace = None
+    elif trace is None:
+        env.gae_trace = tracing.start(dump=dump)
+    elif dump is not None:
+        trace.dump = dump
+
+
+def worker(cmd='status', timeout=daemon.IDLE_TIMEOUT):
+    """Manages a long-lived local worker that keeps the local API stubs and
+imported models warm. While it is running, local shell commands, loaddata and
+dumpjson are handed off to it instead of setting up the stubs from scratch.
+
+Optional arguments:
+
+    :cmd -- The action to take. Defaults to 'status'. Must be one of 'start',
+    'stop' or 'status'.
+
+    :timeout -- How many seconds the worker may sit idle before it shuts
+    itself down. Defaults to 600.
+
+Usage:
+
+    # Start a worker, which exits after 10 idle minutes
+    fab worker:start
+
+    # Start a worker that exits after an idle hour
+    fab worker:start,timeout=3600
+
+    # These now run on the worker
+    fab loaddata:groups/fixtures/test_groups.json
+    fab shell:cmd="print db.Query().count()"
+
+    # Check on the worker, then stop it (e.g. after changing your models)
+    fab worker
+    fab worker:stop
+"""
+    if cmd == 'start':
+        status = daemon.start(idle_timeout=int(timeout))
+        print 'Started local worker (pid %d) at %s' % (
+            status['pid'], status['socket'])
+        return
+
+    if cmd not in ('stop', 'status'):
+        abort('Invalid worker command. Valid commands: start, stop, status')
+
+    status = daemon.request(cmd)
+    if status is None:
+        print 'No local worker is running.'
+    elif cmd == 'stop':
+        print 'Stopped local worker (pid %d)' % status['pid']
+    else:
+        print '\n'.join([
+            'Local worker for %(application)s (pid %(pid)d)',
+            '  socket:   %(socket)s',
+            '  uptime:   %(uptime).0fs',
+            '  idle:     %(idle).0fs of %(idle_timeout)ds',
+            '  commands: %(served)d',
+            ]) % status
+
+
 if __name__ == '__main__':
     shell()
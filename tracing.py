@@ -0,0 +1,180 @@
+"""
+RPC tracing -- Records every App Engine API call made through the API proxy
+while a task runs, so that slow tasks can be broken down into round trips,
+payload sizes and server time.
+"""
+
+from __future__ import with_statement
+
+import atexit
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from django.utils import simplejson as json
+
+
+# The prefix of the names under which our hooks are registered on the API
+# proxy. Hooks can't be removed once added, so each trace uses its own name.
+HOOK_NAME = 'gaefab_trace'
+
+# Upper bounds, in milliseconds, of the buckets in the latency histograms.
+# Anything slower than the last bound lands in a final overflow bucket.
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# The widest bar drawn in a latency histogram
+HISTOGRAM_WIDTH = 40
+
+
+class Trace(object):
+    """Collects a record of the service, method, latency and request and
+    response sizes of each API call made through the proxies it is installed
+    on.
+    """
+
+    def __init__(self, dump=None):
+        self.dump = dump
+        self.enabled = True
+        self.records = []
+        self._proxies = []
+        self._started = {}
+
+    def install(self, proxy=None):
+        """Installs the tracing hooks on the given API proxy, which defaults
+        to the current global proxy. Must be called after the stubs are set
+        up, because setting them up may replace the global proxy.
+        """
+        proxy = proxy or apiproxy_stub_map.apiproxy
+        if proxy in self._proxies:
+            return
+        name = '%s_%d' % (HOOK_NAME, id(self))
+        proxy.GetPreCallHooks().Append(name, self.pre_call)
+        proxy.GetPostCallHooks().Append(name, self.post_call)
+        self._proxies.append(proxy)
+
+    def disable(self):
+        """Stops recording calls and suppresses the summary at exit. The
+        hooks stay installed, since they can't be removed, but do nothing.
+        """
+        self.enabled = False
+        self.records = []
+        self._started = {}
+
+    def pre_call(self, service, call, request, response):
+        if not self.enabled:
+            return
+        # Calls may be made asynchronously, so the start times are tracked
+        # per request rather than assuming one call is in flight at a time.
+        self._started[id(request)] = time.time()
+
+    def post_call(self, service, call, request, response):
+        if not self.enabled:
+            return
+        end = time.time()
+        start = self._started.pop(id(request), end)
+        self.records.append({
+            'service': service,
+            'method': call,
+            'start': start,
+            'latency': (end - start) * 1000.0,
+            'request_bytes': byte_size(request),
+            'response_bytes': byte_size(response),
+            })
+
+    def finish(self):
+        """Prints a summary of the recorded calls and, if requested, dumps
+        the raw records to a file.
+        """
+        if not self.enabled:
+            return
+        print summarize(self.records)
+        if self.dump:
+            with open(self.dump, 'w') as f:
+                for record in self.records:
+                    f.write(json.dumps(record) + '\n')
+            print 'Wrote %d trace records to %s' % (
+                len(self.records), self.dump)
+
+
+def start(dump=None):
+    """Creates a new trace whose summary will be printed when fab exits."""
+    trace = Trace(dump=dump)
+    atexit.register(trace.finish)
+    return trace
+
+def byte_size(message):
+    """Returns the encoded size of the given protocol buffer message, or 0 if
+    it cannot be determined.
+    """
+    try:
+        return message.ByteSize()
+    except Exception:
+        return 0
+
+def summarize(records):
+    """Formats a summary of the given trace records, grouped by service and
+    method, including a latency histogram for each group.
+    """
+    if not records:
+        return '\nRPC trace: no API calls were made.'
+
+    groups = {}
+    for record in records:
+        name = '%s.%s' % (record['service'], record['method'])
+        groups.setdefault(name, []).append(record)
+
+    total = lambda rs, field: sum(r[field] for r in rs)
+    lines = ['',
+             'RPC trace: %d calls, %.1f ms, %d bytes sent, %d bytes received'
+             % (len(records), total(records, 'latency'),
+                total(records, 'request_bytes'),
+                total(records, 'response_bytes'))]
+
+    # Show the groups that took the most time first
+    ordered = sorted(groups.iteritems(),
+                     key=lambda (name, rs): total(rs, 'latency'),
+                     reverse=True)
+    for name, rs in ordered:
+        latencies = sorted(r['latency'] for r in rs)
+        lines.append('')
+        lines.append(name)
+        lines.append('=' * len(name))
+        lines.append(
+            '  calls: %d  total: %.1f ms  mean: %.1f ms  '
+            'median: %.1f ms  max: %.1f ms' % (
+                len(rs), sum(latencies), sum(latencies) / len(latencies),
+                latencies[len(latencies) // 2], latencies[-1]))
+        lines.append(
+            '  request bytes: %d (mean %d)  response bytes: %d (mean %d)' % (
+                total(rs, 'request_bytes'),
+                total(rs, 'request_bytes') // len(rs),
+                total(rs, 'response_bytes'),
+                total(rs, 'response_bytes') // len(rs)))
+        lines.extend(histogram(latencies))
+    return '\n'.join(lines)
+
+def histogram(latencies):
+    """Returns the lines of a text histogram of the given latencies, in
+    milliseconds, bucketed according to LATENCY_BUCKETS.
+    """
+    counts = [0] * (len(LATENCY_BUCKETS) + 1)
+    for latency in latencies:
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency < bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+
+    labels = ['< %d ms' % bound for bound in LATENCY_BUCKETS]
+    labels.append('>= %d ms' % LATENCY_BUCKETS[-1])
+    width = max(len(label) for label in labels)
+    most = max(counts)
+
+    # Only show the range of buckets that actually contain calls
+    used = [i for i, count in enumerate(counts) if count]
+    lines = []
+    for i in range(used[0], used[-1] + 1):
+        bar = '#' * int(round(float(counts[i]) / most * HISTOGRAM_WIDTH))
+        lines.append('  %s | %-*s %d' % (
+            labels[i].rjust(width), HISTOGRAM_WIDTH, bar, counts[i]))
+    return lines
@@ -18,7 +18,6 @@ except ImportError:
     sys.path = extra_paths + sys.path
     from google.appengine.api import appinfo
 from google.appengine.ext.remote_api import remote_api_stub
-from google.appengine.tools import dev_appserver, dev_appserver_main
 
 from fabric.api import env, abort
 
@@ -93,8 +92,12 @@ def ensure_gae_env(func):
 @with_appcfg
 def prep_local_shell():
     """Prepares a local shell by setting up the appropriate stubs."""
+    # Imported here because dev_appserver is slow to import and only needed
+    # when we aren't handing work off to a running local worker.
+    from google.appengine.tools import dev_appserver, dev_appserver_main
     args = dev_appserver_main.DEFAULT_ARGS.copy()
     dev_appserver.SetupStubs(env.gae.application, **args)
+    install_trace()
 
 @with_appcfg
 def prep_remote_shell(path=REMOTE_API_PATH):
@@ -108,6 +111,28 @@ def prep_remote_shell(path=REMOTE_API_PATH):
         None, path, auth_func, servername=env.gae.host)
     remote_api_stub.MaybeInvokeAuthentication()
     os.environ['SERVER_SOFTWARE'] = 'Development (remote_api_shell)/1.0'
+    install_trace()
+
+def install_trace():
+    """Installs the RPC tracing hooks on the current API proxy, if tracing
+    was turned on by the `trace` task.
+    """
+    trace = getattr(env, 'gae_trace', None)
+    if trace is not None:
+        trace.install()
+
+def shell_namespace():
+    """Returns a dict, usable as locals(), of the modules made available by
+    default in a shell.
+    """
+    from google.appengine.api import urlfetch
+    from google.appengine.api import memcache
+    from google.appengine.ext import deferred
+    from google.appengine.ext import db
+
+    modname = lambda m: m.__name__.rpartition('.')[-1]
+    mods = [db, deferred, memcache, sys, urlfetch]
+    return dict((modname(m), m) for m in mods)
 
 def make_auth_func():
     """Creates an appropriate auth_func for the remote_api_stub. If a file